@@ -15,12 +15,14 @@ import base64
 import collections
 import fnmatch
 import httplib
+import itertools
 import json
 import logging
 import multiprocessing
 import optparse
 import os
 import re
+import socket
 import stat
 import sys
 import tempfile
@@ -80,6 +82,9 @@ DEFAULT_LINT_IGNORE_REGEX = r"$^"
 # Buildbucket master name prefix.
 MASTER_PREFIX = 'master.'
 
+# Format of the --contributor argument of git cl land: "First Last <email>".
+CONTRIBUTOR_RE = re.compile(r'^.*\s<(?P<email>\S+@\S+)>$')
+
 # Shortcut since it quickly becomes redundant.
 Fore = colorama.Fore
 
@@ -334,7 +339,17 @@ def _buildbucket_retry(operation_name, http, *args, **kwargs):
   """Retries requests to buildbucket service and returns parsed json content."""
   try_count = 0
   while True:
-    response, content = http.request(*args, **kwargs)
+    try:
+      response, content = http.request(*args, **kwargs)
+    except socket.error as e:
+      # Timeouts and dropped connections are as transient as 5xx responses.
+      if try_count >= 2:
+        raise
+      logging.debug('Transient errors when %s: %s. Will retry.',
+                    operation_name, e)
+      time_sleep(0.5 + 1.5*try_count)
+      try_count += 1
+      continue
     try:
       content_json = json.loads(content)
     except ValueError:
@@ -743,6 +758,8 @@ class Settings(object):
     self.project = None
     self.force_https_commit_url = None
     self.pending_ref_prefix = None
+    self.git_mirrors = {}
+    self.remote_urls = {}
 
   def LazyUpdateIfNeeded(self):
     """Updates the settings from a codereview.settings file, if available."""
@@ -781,9 +798,20 @@ class Settings(object):
       self.root = os.path.abspath(self.GetRelativeRoot())
     return self.root
 
+  def GetRemoteUrl(self, remote='origin'):
+    if remote not in self.remote_urls:
+      self.remote_urls[remote] = RunGit(
+          ['config', '--get', 'remote.%s.url' % remote]).strip()
+    return self.remote_urls[remote]
+
   def GetGitMirror(self, remote='origin'):
     """If this checkout is from a local git mirror, return a Mirror object."""
-    local_url = RunGit(['config', '--get', 'remote.%s.url' % remote]).strip()
+    if remote not in self.git_mirrors:
+      self.git_mirrors[remote] = self._GetGitMirror(remote)
+    return self.git_mirrors[remote]
+
+  def _GetGitMirror(self, remote):
+    local_url = self.GetRemoteUrl(remote)
     if not os.path.isdir(local_url):
       return None
     git_cache.Mirror.SetCachePath(os.path.dirname(local_url))
@@ -915,10 +943,27 @@ class _GitNumbererState(object):
       'v8/v8',
   ]
 
+  # load() results keyed by (remote_url, remote_ref). Cleared by main().
+  _cache = {}
+
+  @classmethod
+  def ClearCache(cls):
+    """Forgets all states loaded so far."""
+    cls._cache.clear()
+
   @classmethod
   def load(cls, remote_url, remote_ref):
     """Figures out the state by fetching special refs from remote repo.
+
+    The result is cached, so the fetch happens at most once per command.
     """
+    key = (remote_url, remote_ref)
+    if key not in cls._cache:
+      cls._cache[key] = cls._load(remote_url, remote_ref)
+    return cls._cache[key]
+
+  @classmethod
+  def _load(cls, remote_url, remote_ref):
     assert remote_ref and remote_ref.startswith('refs/'), remote_ref
     url_parts = urlparse.urlparse(remote_url)
     project_name = url_parts.path.lstrip('/').rstrip('git./')
@@ -1151,6 +1196,7 @@ class Changelist(object):
     else:
       self.branch = None
     self.upstream_branch = None
+    self.common_ancestor = None
     self.lookedup_issue = False
     self.issue = issue or None
     self.has_description = False
@@ -1238,7 +1284,7 @@ class Changelist(object):
 
   def ClearBranch(self):
     """Clears cached branch data of this object."""
-    self.branch = self.branchref = None
+    self.branch = self.branchref = self.common_ancestor = None
 
   def _GitGetBranchConfigValue(self, key, default=None, **kwargs):
     assert 'branch' not in kwargs, 'this CL branch is used automatically'
@@ -1288,12 +1334,15 @@ class Changelist(object):
     return remote, upstream_branch
 
   def GetCommonAncestorWithUpstream(self):
-    upstream_branch = self.GetUpstreamBranch()
-    if not BranchExists(upstream_branch):
-      DieWithError('The upstream for the current branch (%s) does not exist '
-                   'anymore.\nPlease fix it and try again.' % self.GetBranch())
-    return git_common.get_or_create_merge_base(self.GetBranch(),
-                                               upstream_branch)
+    if self.common_ancestor is None:
+      upstream_branch = self.GetUpstreamBranch()
+      if not BranchExists(upstream_branch):
+        DieWithError('The upstream for the current branch (%s) does not exist '
+                     'anymore.\nPlease fix it and try again.' %
+                     self.GetBranch())
+      self.common_ancestor = git_common.get_or_create_merge_base(
+          self.GetBranch(), upstream_branch)
+    return self.common_ancestor
 
   def GetUpstreamBranch(self):
     if self.upstream_branch is None:
@@ -1476,13 +1525,15 @@ class Changelist(object):
     if not self.GitSanityChecks(upstream_branch):
       DieWithError('\nGit sanity check failure')
 
-    root = settings.GetRelativeRoot()
+    # Resolve the relative root and the sha1 of HEAD, which we use as a name
+    # of this change, with a single rev-parse.
+    out = RunGit(['rev-parse', '--show-cdup', 'HEAD'])
+    root, _, name = out.partition('\n')
+    root = root.strip()
+    name = name.strip()
     if not root:
       root = '.'
     absroot = os.path.abspath(root)
-
-    # We use the sha1 of HEAD as a name of this change.
-    name = RunGitWithCode(['rev-parse', 'HEAD'])[1].strip()
     # Need to pass a relative path for msysgit.
     try:
       files = scm.GIT.CaptureStatus([root], '.', upstream_branch)
@@ -2749,8 +2800,11 @@ class _GerritChangelistImpl(_ChangelistCodereviewBase):
                         error_ok=True).strip()
         # Verify that the upstream branch has been uploaded too, otherwise
         # Gerrit will create additional CLs when uploading.
-        if not parent or (RunGitSilent(['rev-parse', upstream_branch + ':']) !=
-                          RunGitSilent(['rev-parse', parent + ':'])):
+        trees = []
+        if parent:
+          trees = RunGitSilent(
+              ['rev-parse', upstream_branch + ':', parent + ':']).split()
+        if len(trees) != 2 or trees[0] != trees[1]:
           DieWithError(
               '\nUpload upstream branch %s first.\n'
               'It is likely that this branch has been rebased since its last '
@@ -2941,6 +2995,24 @@ _CODEREVIEW_IMPLEMENTATIONS = {
 }
 
 
+def _GetBranchIssues():
+  """Returns (branch, issue) pairs for all branches with an issue set.
+
+  Reads the issue keys of every codereview implementation with a single git
+  config call instead of creating a Changelist per branch.
+  """
+  issue_keys = sorted(cls.IssueConfigKey()
+                      for cls in _CODEREVIEW_IMPLEMENTATIONS.itervalues())
+  output = RunGit(['config', '--local', '--get-regexp',
+                   r'^branch\..*\.(%s)$' % '|'.join(issue_keys)],
+                  error_ok=True)
+  branch_issues = []
+  for line in output.splitlines():
+    key, issue = line.split(' ', 1)
+    branch_issues.append((key[len('branch.'):].rsplit('.', 1)[0], issue))
+  return branch_issues
+
+
 def _add_codereview_issue_select_options(parser, extra=""):
   _add_codereview_select_options(parser)
 
@@ -3250,12 +3322,15 @@ def FindCodereviewSettingsFile(filename='codereview.settings'):
   inherit_ok_file = 'inherit-review-settings-ok'
   cwd = os.getcwd()
   root = settings.GetRoot()
-  if os.path.isfile(os.path.join(root, inherit_ok_file)):
+  if os.path.exists(os.path.join(root, inherit_ok_file)):
     root = '/'
   while True:
-    if filename in os.listdir(cwd):
-      if os.path.isfile(os.path.join(cwd, filename)):
-        return open(os.path.join(cwd, filename))
+    path = os.path.join(cwd, filename)
+    # A single stat rules out most directories cheaply; the directory listing
+    # is only read to confirm the exact case of the name on case-insensitive
+    # filesystems.
+    if os.path.isfile(path) and filename in os.listdir(cwd):
+      return open(path)
     if cwd == root:
       break
     cwd = os.path.dirname(cwd)
@@ -3311,15 +3386,22 @@ def LoadCodereviewSettingsFromFile(fileobj):
 
 def urlretrieve(source, destination):
   """urllib is broken for SSL connections via a proxy therefore we
-  can't use urllib.urlretrieve()."""
-  with open(destination, 'w') as f:
-    f.write(urllib2.urlopen(source).read())
+  can't use urllib.urlretrieve().
 
-
-def hasSheBang(fname):
-  """Checks fname is a #! script."""
-  with open(fname) as f:
-    return f.read(2).startswith('#!')
+  Streams the content into destination and returns its first two bytes, so that
+  callers can inspect the header without re-reading the file.
+  """
+  head = ''
+  response = urllib2.urlopen(source)
+  with open(destination, 'w') as f:
+    while True:
+      chunk = response.read(64 * 1024)
+      if not chunk:
+        break
+      if len(head) < 2:
+        head += chunk[:2 - len(head)]
+      f.write(chunk)
+  return head
 
 
 # TODO(bpastene) Remove once a cleaner fix to crbug.com/600473 presents itself.
@@ -3342,8 +3424,7 @@ def DownloadGerritHook(force):
       if not force:
         return
     try:
-      urlretrieve(src, dst)
-      if not hasSheBang(dst):
+      if not urlretrieve(src, dst).startswith('#!'):
         DieWithError('Not a script: %s\n'
                      'You need to download from\n%s\n'
                      'into .git/hooks/commit-msg and '
@@ -3767,9 +3848,11 @@ def CMDstatus(parser, args):
                            max_processes=options.maxjobs)
 
   branch_statuses = {}
-  alignment = max(5, max(len(ShortBranchName(c.GetBranch())) for c in changes))
-  for cl in sorted(changes, key=lambda c: c.GetBranch()):
-    branch = cl.GetBranch()
+  # Look up each branch name once and reuse it for both alignment and ordering.
+  sorted_changes = sorted(((c, c.GetBranch()) for c in changes),
+                          key=lambda x: x[1])
+  alignment = max(5, max(len(ShortBranchName(b)) for _, b in sorted_changes))
+  for cl, branch in sorted_changes:
     while branch not in branch_statuses:
       c, status = output.next()
       branch_statuses[c.GetBranch()] = status
@@ -3806,22 +3889,28 @@ def CMDstatus(parser, args):
 def colorize_CMDstatus_doc():
   """To be called once in main() to add colors to git cl status help."""
   colors = [i for i in dir(Fore) if i[0].isupper()]
+  # A single alternation regex does one scan per line instead of one substring
+  # check per color.
+  color_re = re.compile(r'\b(%s)\b' % '|'.join(colors), re.IGNORECASE)
 
   def colorize_line(line):
-    for color in colors:
-      if color in line.upper():
-        # Extract whitespaces first and the leading '-'.
-        indent = len(line) - len(line.lstrip(' ')) + 1
-        return line[:indent] + getattr(Fore, color) + line[indent:] + Fore.RESET
-    return line
+    match = color_re.search(line)
+    if not match:
+      return line
+    # Extract whitespaces first and the leading '-'.
+    indent = len(line) - len(line.lstrip(' ')) + 1
+    color = getattr(Fore, match.group(1).upper())
+    return line[:indent] + color + line[indent:] + Fore.RESET
 
   lines = CMDstatus.__doc__.splitlines()
   CMDstatus.__doc__ = '\n'.join(colorize_line(l) for l in lines)
 
 
 def write_json(path, contents):
+  # json.dumps() uses the C encoder and emits a single write, unlike json.dump()
+  # which goes through the pure Python iterative encoder.
   with open(path, 'w') as f:
-    json.dump(contents, f)
+    f.write(json.dumps(contents))
 
 
 @subcommand.usage('[issue_number]')
@@ -3844,10 +3933,13 @@ def CMDissue(parser, args):
                        '--format=%(refname:short)']).splitlines()
 
     # Reverse issue lookup.
-    issue_branch_map = {}
+    branch_issues = collections.defaultdict(list)
+    for branch, issue in _GetBranchIssues():
+      branch_issues[branch].append(int(issue))
+    issue_branch_map = collections.defaultdict(list)
     for branch in branches:
-      cl = Changelist(branchref=branch)
-      issue_branch_map.setdefault(cl.GetIssue(), []).append(branch)
+      for issue in branch_issues.get(branch, []):
+        issue_branch_map[issue].append(branch)
     if not args:
       args = sorted(issue_branch_map.iterkeys())
     result = {}
@@ -3928,8 +4020,7 @@ def CMDcomments(parser, args):
     if message['text'].strip():
       print('\n'.join('  ' + l for l in message['text'].splitlines()))
   if options.json_file:
-    with open(options.json_file, 'wb') as f:
-      json.dump(summary, f)
+    write_json(options.json_file, summary)
   return 0
 
 
@@ -4124,6 +4215,29 @@ def GenerateGerritChangeId(message):
   return 'I%s' % change_hash.strip()
 
 
+@git_common.memoize_one(threadsafe=False)
+def _GetTargetBranchPrefixRegex(remote):
+  """Returns a compiled regex matching the prefix of a target branch of the
+  given remote which is canonicalized to the equivalent local full symbolic ref.
+
+  Alternatives are tried in order, so branch-heads take precedence over the
+  remote name, which takes precedence over heads.
+  """
+  return re.compile(
+      r'^(?:(?P<branch_heads>(?:(?:refs/)?remotes/)?branch-heads/)|'
+      r'(?:(?:refs/)?remotes/)?%s/|(?:refs/)?heads/)' % re.escape(remote))
+
+
+@git_common.memoize_one(threadsafe=False)
+def _GetRemoteRefRegex(remote):
+  """Returns a compiled regex splitting a local ref of the given remote into
+  the parts needed to translate it into the remote's own ref.
+  """
+  return re.compile(
+      r'^refs/remotes/(?:%(remote)s/(?P<ref>refs/.*)|%(remote)s/(?P<head>.*)|'
+      r'(?P<branch_heads>branch-heads.*))$' % {'remote': re.escape(remote)})
+
+
 def GetTargetRef(remote, remote_branch, target_branch, pending_prefix_check,
                  remote_url=None):
   """Computes the remote branch ref to use for the CL.
@@ -4146,20 +4260,16 @@ def GetTargetRef(remote, remote_branch, target_branch, pending_prefix_check,
     if '/' not in target_branch:
       remote_branch = 'refs/remotes/%s/%s' % (remote, target_branch)
     else:
-      prefix_replacements = (
-        ('^((refs/)?remotes/)?branch-heads/', 'refs/remotes/branch-heads/'),
-        ('^((refs/)?remotes/)?%s/' % remote,  'refs/remotes/%s/' % remote),
-        ('^(refs/)?heads/',                   'refs/remotes/%s/' % remote),
-      )
-      match = None
-      for regex, replacement in prefix_replacements:
-        match = re.search(regex, target_branch)
-        if match:
-          remote_branch = target_branch.replace(match.group(0), replacement)
-          break
+      match = _GetTargetBranchPrefixRegex(remote).match(target_branch)
       if not match:
         # This is a branch path but not one we recognize; use as-is.
         remote_branch = target_branch
+      elif match.group('branch_heads') is not None:
+        remote_branch = ('refs/remotes/branch-heads/' +
+                         target_branch[match.end():])
+      else:
+        remote_branch = ('refs/remotes/%s/' % remote +
+                         target_branch[match.end():])
   elif remote_branch in REFS_THAT_ALIAS_TO_OTHER_REFS:
     # Handle the refs that need to land in different refs.
     remote_branch = REFS_THAT_ALIAS_TO_OTHER_REFS[remote_branch]
@@ -4169,13 +4279,14 @@ def GetTargetRef(remote, remote_branch, target_branch, pending_prefix_check,
   # * refs/remotes/origin/refs/diff/test -> refs/diff/test
   # * refs/remotes/origin/master -> refs/heads/master
   # * refs/remotes/branch-heads/test -> refs/branch-heads/test
-  if remote_branch.startswith('refs/remotes/%s/refs/' % remote):
-    remote_branch = remote_branch.replace('refs/remotes/%s/' % remote, '')
-  elif remote_branch.startswith('refs/remotes/%s/' % remote):
-    remote_branch = remote_branch.replace('refs/remotes/%s/' % remote,
-                                          'refs/heads/')
-  elif remote_branch.startswith('refs/remotes/branch-heads'):
-    remote_branch = remote_branch.replace('refs/remotes/', 'refs/')
+  match = _GetRemoteRefRegex(remote).match(remote_branch)
+  if match:
+    if match.group('ref') is not None:
+      remote_branch = match.group('ref')
+    elif match.group('head') is not None:
+      remote_branch = 'refs/heads/' + match.group('head')
+    else:
+      remote_branch = 'refs/' + match.group('branch_heads')
 
   if pending_prefix_check:
     # If a pending prefix exists then replace refs/ with it.
@@ -4190,10 +4301,12 @@ def cleanup_list(l):
 
   So that "--reviewers joe@c,john@c --reviewers joa@c" results in
   options.reviewers == sorted(['joe@c', 'john@c', 'joa@c']).
+  Duplicate items are dropped.
   """
-  items = sum((i.split(',') for i in l), [])
-  stripped_items = (i.strip() for i in items)
-  return sorted(filter(None, stripped_items))
+  if not l:
+    return []
+  items = itertools.chain.from_iterable(i.split(',') for i in l)
+  return sorted({s for s in (i.strip() for i in items) if s})
 
 
 @subcommand.usage('[args to "git diff"]')
@@ -4286,9 +4399,6 @@ def CMDupload(parser, args):
   if options.cq_dry_run and options.use_commit_queue:
     parser.error('only one of --use-commit-queue and --cq-dry-run allowed.')
 
-  # For sanity of test expectations, do this otherwise lazy-loading *now*.
-  settings.GetIsGerrit()
-
   cl = Changelist(auth_config=auth_config, codereview=options.forced_codereview)
   return cl.CMDUpload(options, args, orig_args)
 
@@ -4297,8 +4407,8 @@ def WaitForRealCommit(remote, pushed_commit, local_base_ref, real_ref):
   print()
   print('Waiting for commit to be landed on %s...' % real_ref)
   print('(If you are impatient, you may Ctrl-C once without harm)')
-  target_tree = RunGit(['rev-parse', '%s:' % pushed_commit]).strip()
-  current_rev = RunGit(['rev-parse', local_base_ref]).strip()
+  target_tree, current_rev = RunGit(
+      ['rev-parse', '%s:' % pushed_commit, local_base_ref]).split()
   mirror = settings.GetGitMirror(remote)
 
   loop = 0
@@ -4311,13 +4421,19 @@ def WaitForRealCommit(remote, pushed_commit, local_base_ref, real_ref):
       mirror.populate()
     RunGit(['retry', 'fetch', remote, real_ref], stderr=subprocess2.VOID)
     to_rev = RunGit(['rev-parse', 'FETCH_HEAD']).strip()
-    commits = RunGit(['rev-list', '%s..%s' % (current_rev, to_rev)])
-    for commit in commits.splitlines():
-      if RunGit(['rev-parse', '%s:' % commit]).strip() == target_tree:
+    # List each new commit with its tree in one call instead of running
+    # rev-parse per commit.
+    commits = RunGit(['log', '--format=%H %T',
+                      '%s..%s' % (current_rev, to_rev)])
+    for line in commits.splitlines():
+      commit, _, tree = line.partition(' ')
+      if tree == target_tree:
         print('Found commit on %s' % real_ref)
         return commit
 
     current_rev = to_rev
+    # Back off so a slow commit bot doesn't get the remote hammered.
+    time_sleep(min(30, 2 ** loop))
 
 
 def PushToGitPending(remote, pending_ref):
@@ -4448,7 +4564,7 @@ def CMDland(parser, args):
                                        options.verbose)
 
   current = cl.GetBranch()
-  remote, upstream_branch = cl.FetchUpstreamTuple(cl.GetBranch())
+  remote, upstream_branch = cl.FetchUpstreamTuple(current)
   if remote == '.':
     print()
     print('Attempting to push branch %r into another local branch!' % current)
@@ -4466,8 +4582,10 @@ def CMDland(parser, args):
     # Default to merging against our best guess of the upstream branch.
     args = [cl.GetUpstreamBranch()]
 
+  contributor_match = None
   if options.contributor:
-    if not re.match('^.*\s<\S+@\S+>$', options.contributor):
+    contributor_match = CONTRIBUTOR_RE.match(options.contributor)
+    if not contributor_match:
       print("Please provide contibutor as 'First Last <email@example.com>'")
       return 1
 
@@ -4476,21 +4594,21 @@ def CMDland(parser, args):
   if git_common.is_dirty_git_tree('land'):
     return 1
 
-  # This rev-list syntax means "show all commits not in my branch that
+  # This rev-list syntax means "count all commits not in my branch that
   # are in base_branch".
-  upstream_commits = RunGit(['rev-list', '^' + cl.GetBranchRef(),
-                             base_branch]).splitlines()
+  upstream_commits = int(RunGit(['rev-list', '--count', '^' + cl.GetBranchRef(),
+                                 base_branch]).strip())
   if upstream_commits:
     print('Base branch "%s" has %d commits '
-          'not in this branch.' % (base_branch, len(upstream_commits)))
+          'not in this branch.' % (base_branch, upstream_commits))
     print('Run "git merge %s" before attempting to land.' % base_branch)
     return 1
 
   merge_base = RunGit(['merge-base', base_branch, 'HEAD']).strip()
   if not options.bypass_hooks:
     author = None
-    if options.contributor:
-      author = re.search(r'\<(.*)\>', options.contributor).group(1)
+    if contributor_match:
+      author = contributor_match.group('email')
     hook_results = cl.RunHook(
         committing=True,
         may_prompt=not options.force,
@@ -4550,12 +4668,9 @@ def CMDland(parser, args):
   # keeps the working copy the same), then landing that.
   MERGE_BRANCH = 'git-cl-commit'
   CHERRY_PICK_BRANCH = 'git-cl-cherry-pick'
-  # Delete the branches if they exist.
+  # Delete the branches if they exist. "branch -D" just fails if they don't.
   for branch in [MERGE_BRANCH, CHERRY_PICK_BRANCH]:
-    showref_cmd = ['show-ref', '--quiet', '--verify', 'refs/heads/%s' % branch]
-    result = RunGitWithCode(showref_cmd)
-    if result[0] == 0:
-      RunGit(['branch', '-D', branch])
+    RunGitWithCode(['branch', '-D', branch], suppress_stderr=True)
 
   # We might be in a directory that's present in this branch but not in the
   # trunk.  Move up to the top of the tree so that git commands that expect a
@@ -4583,15 +4698,15 @@ def CMDland(parser, args):
     else:
       RunGit(['commit', '-m', commit_desc.description])
 
-    remote, branch = cl.FetchUpstreamTuple(cl.GetBranch())
+    branch = upstream_branch
     mirror = settings.GetGitMirror(remote)
     if mirror:
       pushurl = mirror.url
       git_numberer = _GitNumbererState.load(pushurl, branch)
     else:
       pushurl = remote  # Usually, this is 'origin'.
-      git_numberer = _GitNumbererState.load(
-          RunGit(['config', 'remote.%s.url' % remote]).strip(), branch)
+      git_numberer = _GitNumbererState.load(settings.GetRemoteUrl(remote),
+                                            branch)
 
     if git_numberer.should_add_git_number:
       # TODO(tandrii): run git fetch in a loop + autorebase when there there
@@ -4787,15 +4902,28 @@ def CMDpatch(parser, args):
                           options.directory)
 
 
+# Shared by the tree status helpers so that a command asking for both the
+# status and the reason reuses one keep-alive connection.
+_TREE_STATUS_HTTP = httplib2.Http(timeout=10)
+
+
+def _FetchTreeStatusUrl(url):
+  resp, content = _TREE_STATUS_HTTP.request(url)
+  if resp.status != 200:
+    raise httplib2.HttpLib2Error(
+        'Failed to fetch %s: HTTP %s' % (url, resp.status))
+  return content
+
+
 def GetTreeStatus(url=None):
   """Fetches the tree status and returns either 'open', 'closed',
   'unknown' or 'unset'."""
   url = url or settings.GetTreeStatusUrl(error_ok=True)
   if url:
-    status = urllib2.urlopen(url).read().lower()
-    if status.find('closed') != -1 or status == '0':
+    status = _FetchTreeStatusUrl(url).lower()
+    if 'closed' in status or status == '0':
       return 'closed'
-    elif status.find('open') != -1 or status == '1':
+    elif 'open' in status or status == '1':
       return 'open'
     return 'unknown'
   return 'unset'
@@ -4806,9 +4934,7 @@ def GetTreeStatusReason():
   with the reason for the tree to be opened or closed."""
   url = settings.GetTreeStatusUrl()
   json_url = urlparse.urljoin(url, '/current?format=json')
-  connection = urllib2.urlopen(json_url)
-  status = json.loads(connection.read())
-  connection.close()
+  status = json.loads(_FetchTreeStatusUrl(json_url))
   return status['message']
 
 
@@ -4901,13 +5027,14 @@ def CMDtry(parser, args):
       print('git cl try with no bots now defaults to CQ Dry Run.')
     return cl.TriggerDryRun()
 
-  for builders in buckets.itervalues():
-    if any('triggered' in b for b in builders):
-      print('ERROR You are trying to send a job to a triggered bot. This type '
-            'of bot requires an initial job from a parent (usually a builder). '
-            'Instead send your job to the parent.\n'
-            'Bot list: %s' % builders, file=sys.stderr)
-      return 1
+  triggered = [b for builders in buckets.itervalues() for b in builders
+               if 'triggered' in b]
+  if triggered:
+    print('ERROR You are trying to send a job to a triggered bot. This type '
+          'of bot requires an initial job from a parent (usually a builder). '
+          'Instead send your job to the parent.\n'
+          'Bot list: %s' % triggered, file=sys.stderr)
+    return 1
 
   patchset = cl.GetMostRecentPatchset()
   # TODO(tandrii): Checking local patchset against remote patchset is only
@@ -5148,37 +5275,77 @@ def CMDowners(parser, args):
 
   change = cl.GetChange(base_branch, None)
   return owners_finder.OwnersFinder(
-      [f.LocalPath() for f in
-          cl.GetChange(base_branch, None).AffectedFiles()],
+      [f.LocalPath() for f in change.AffectedFiles()],
       change.RepositoryRoot(), author,
       fopen=file, os_path=os.path,
       disable_color=options.no_color).run()
 
 
+def _ParallelMap(func, items, jobs):
+  """Like map(func, items), but runs func on a pool of |jobs| threads.
+
+  Waits with a timeout so that Ctrl-C still interrupts the main thread; a
+  plain pool.map() ignores KeyboardInterrupt on Python 2 until it is done.
+  """
+  with git_common.ScopedPool(jobs, kind='threads') as pool:
+    result = pool.map_async(func, items)
+    while not result.ready():
+      result.wait(0.5)
+    return result.get()
+
+
 def BuildGitDiffCmd(diff_type, upstream_commit, args):
   """Generates a diff command."""
-  # Generate diff for the current branch's changes.
-  diff_cmd = ['diff', '--no-ext-diff', '--no-prefix', diff_type,
-              upstream_commit, '--' ]
+  # Generate diff for the current branch's changes. Let git leave out files
+  # deleted by this CL, and keep color codes out of output we parse.
+  diff_cmd = ['diff', '--no-ext-diff', '--no-prefix', '--no-color',
+              '--diff-filter=d', diff_type, upstream_commit, '--']
 
   if args:
     for arg in args:
-      if os.path.isdir(arg) or os.path.isfile(arg):
+      try:
+        mode = os.stat(arg).st_mode
+      except OSError:
+        mode = 0
+      if stat.S_ISDIR(mode) or stat.S_ISREG(mode):
         diff_cmd.append(arg)
       else:
         DieWithError('Argument "%s" is not a file or a directory' % arg)
 
   return diff_cmd
 
-def MatchingFileType(file_name, extensions):
-  """Returns true if the file name ends with one of the given extensions."""
-  return bool([ext for ext in extensions if file_name.lower().endswith(ext)])
+def SplitGitDiff(diff):
+  """Splits the output of a --no-prefix git diff into per-file chunks.
+
+  Returns a list of (file name, diff chunk) tuples in diff order.
+  """
+  chunks = []
+  for line in diff.splitlines(True):
+    if line.startswith('diff --git '):
+      chunks.append([line])
+    elif chunks:
+      chunks[-1].append(line)
+
+  result = []
+  for lines in chunks:
+    # Unless the file was renamed or copied, both sides of the header name
+    # the same file.
+    paths = lines[0][len('diff --git '):].rstrip('\n')
+    file_name = paths[:len(paths) // 2]
+    for line in lines[1:]:
+      if line.startswith(('rename to ', 'copy to ')):
+        file_name = line.split(' to ', 1)[1].rstrip('\n')
+        break
+      if line.startswith(('---', '@@')):
+        break
+    result.append((file_name, ''.join(lines)))
+  return result
 
 @subcommand.usage('[files or directories to diff]')
 def CMDformat(parser, args):
   """Runs auto-formatting tools (clang-format etc.) on the diff."""
-  CLANG_EXTS = ['.cc', '.cpp', '.h', '.m', '.mm', '.proto', '.java']
-  GN_EXTS = ['.gn', '.gni', '.typemap']
+  CLANG_EXTS = ('.cc', '.cpp', '.h', '.m', '.mm', '.proto', '.java')
+  GN_EXTS = ('.gn', '.gni', '.typemap')
   parser.add_option('--full', action='store_true',
                     help='Reformat the full content of all touched files')
   parser.add_option('--dry-run', action='store_true',
@@ -5191,13 +5358,15 @@ def CMDformat(parser, args):
 
   # Normalize any remaining args against the current path, so paths relative to
   # the current directory are still resolved as expected.
-  args = [os.path.join(os.getcwd(), arg) for arg in args]
+  cwd = os.getcwd()
+  args = [os.path.join(cwd, arg) for arg in args]
 
   # git diff generates paths against the root of the repository.  Change
   # to that directory so clang-format can find files even within subdirs.
   rel_base_path = settings.GetRelativeRoot()
   if rel_base_path:
     os.chdir(rel_base_path)
+  top_dir = os.getcwd()
 
   # Grab the merge-base commit, i.e. the upstream commit of the current
   # branch when it was created or the last time it was rebased. This is
@@ -5214,19 +5383,31 @@ def CMDformat(parser, args):
     DieWithError('Could not find base commit for this branch. '
                  'Are you in detached state?')
 
-  changed_files_cmd = BuildGitDiffCmd('--name-only', upstream_commit, args)
-  diff_output = RunGit(changed_files_cmd)
-  diff_files = diff_output.splitlines()
-  # Filter out files deleted by this CL
-  diff_files = [x for x in diff_files if os.path.isfile(x)]
-
-  clang_diff_files = [x for x in diff_files if MatchingFileType(x, CLANG_EXTS)]
-  python_diff_files = [x for x in diff_files if MatchingFileType(x, ['.py'])]
-  dart_diff_files = [x for x in diff_files if MatchingFileType(x, ['.dart'])]
-  gn_diff_files = [x for x in diff_files if MatchingFileType(x, GN_EXTS)]
-
-  top_dir = os.path.normpath(
-      RunGit(["rev-parse", "--show-toplevel"]).rstrip('\n'))
+  if opts.full:
+    changed_files_cmd = BuildGitDiffCmd('--name-only', upstream_commit, args)
+    diff_files = RunGit(changed_files_cmd).splitlines()
+    file_diffs = {}
+  else:
+    # clang-format-diff needs the -U0 diff anyway, so take the changed file
+    # names from it rather than asking git for them separately.
+    diff_output = RunGit(BuildGitDiffCmd('-U0', upstream_commit, args))
+    file_diffs = collections.OrderedDict(SplitGitDiff(diff_output))
+    diff_files = file_diffs.keys()
+  clang_diff_files = []
+  python_diff_files = []
+  dart_diff_files = []
+  gn_diff_files = []
+  # Sort the changed files by formatter in a single pass.
+  for diff_file in diff_files:
+    lower_file = diff_file.lower()
+    if lower_file.endswith(CLANG_EXTS):
+      clang_diff_files.append(diff_file)
+    elif lower_file.endswith('.py'):
+      python_diff_files.append(diff_file)
+    elif lower_file.endswith('.dart'):
+      dart_diff_files.append(diff_file)
+    elif lower_file.endswith(GN_EXTS):
+      gn_diff_files.append(diff_file)
 
   # Set to 2 to signal to CheckPatchFormatted() that this patch isn't
   # formatted. This is used to block during the presubmit.
@@ -5243,26 +5424,35 @@ def CMDformat(parser, args):
       cmd = [clang_format_tool]
       if not opts.dry_run and not opts.diff:
         cmd.append('-i')
-      stdout = RunCommand(cmd + clang_diff_files, cwd=top_dir)
+      def RunClangFormat(files):
+        return subprocess2.check_output(cmd + files, cwd=top_dir)
+      # clang-format is single threaded, so split the files into contiguous
+      # shards, one per CPU, and format those in parallel. Keeping the shards
+      # contiguous keeps --diff output in file order.
+      jobs = min(len(clang_diff_files), multiprocessing.cpu_count())
+      shard_size = (len(clang_diff_files) + jobs - 1) // jobs
+      shards = [clang_diff_files[i:i + shard_size]
+                for i in range(0, len(clang_diff_files), shard_size)]
+      try:
+        stdout = ''.join(_ParallelMap(RunClangFormat, shards, len(shards)))
+      except subprocess2.CalledProcessError as e:
+        DieWithError(str(e))
       if opts.diff:
         sys.stdout.write(stdout)
     else:
-      env = os.environ.copy()
-      env['PATH'] = str(os.path.dirname(clang_format_tool))
       try:
         script = clang_format.FindClangFormatScriptInChromiumTree(
             'clang-format-diff.py')
       except clang_format.NotFoundError as e:
         DieWithError(e)
 
-      cmd = [sys.executable, script, '-p0']
+      # Point the script at the binary directly instead of rewriting PATH.
+      cmd = [sys.executable, script, '-p0', '-binary', clang_format_tool]
       if not opts.dry_run and not opts.diff:
         cmd.append('-i')
 
-      diff_cmd = BuildGitDiffCmd('-U0', upstream_commit, clang_diff_files)
-      diff_output = RunGit(diff_cmd)
-
-      stdout = RunCommand(cmd, stdin=diff_output, cwd=top_dir, env=env)
+      clang_diff = ''.join(file_diffs[f] for f in clang_diff_files)
+      stdout = RunCommand(cmd, stdin=clang_diff, cwd=top_dir)
       if opts.diff:
         sys.stdout.write(stdout)
       if opts.dry_run and len(stdout) > 0:
@@ -5310,10 +5500,15 @@ def CMDformat(parser, args):
     cmd = ['gn', 'format' ]
     if opts.dry_run or opts.diff:
       cmd.append('--dry-run')
-    for gn_diff_file in gn_diff_files:
-      gn_ret = subprocess2.call(cmd + [gn_diff_file],
-                                shell=sys.platform == 'win32',
-                                cwd=top_dir)
+    def RunGnFormat(gn_diff_file):
+      return subprocess2.call(cmd + [gn_diff_file],
+                              shell=sys.platform == 'win32',
+                              cwd=top_dir)
+    # gn format takes one file at a time, so run those in parallel.
+    gn_rets = _ParallelMap(
+        RunGnFormat, gn_diff_files,
+        min(len(gn_diff_files), multiprocessing.cpu_count()))
+    for gn_diff_file, gn_ret in zip(gn_diff_files, gn_rets):
       if opts.dry_run and gn_ret == 2:
         return_value = 2  # Not formatted.
       elif opts.diff and gn_ret == 2:
@@ -5344,17 +5539,9 @@ def CMDcheckout(parser, args):
     return 1
   target_issue = str(issue_arg.issue)
 
-  def find_issues(issueprefix):
-    output = RunGit(['config', '--local', '--get-regexp',
-                     r'branch\..*\.%s' % issueprefix],
-                     error_ok=True)
-    for key, issue in [x.split() for x in output.splitlines()]:
-      if issue == target_issue:
-        yield re.sub(r'branch\.(.*)\.%s' % issueprefix, r'\1', key)
-
-  branches = []
-  for cls in _CODEREVIEW_IMPLEMENTATIONS.values():
-    branches.extend(find_issues(cls.IssueConfigKey()))
+  branches = [branch for branch, issue in _GetBranchIssues()
+              if issue == target_issue]
+
   if len(branches) == 0:
     print('No branch found for issue %s.' % target_issue)
     return 1
@@ -5409,6 +5596,7 @@ def main(argv):
   # Reload settings.
   global settings
   settings = Settings()
+  _GitNumbererState.ClearCache()
 
   colorize_CMDstatus_doc()
   dispatcher = subcommand.CommandDispatcher(__name__)
@@ -10,6 +10,7 @@ import json
 import os
 import StringIO
 import sys
+import tempfile
 import unittest
 import urlparse
 
@@ -272,6 +273,49 @@ class TestGitClBasic(unittest.TestCase):
     self.assertEqual(f('v8', 'chromium:123,456,v8:123'),
                      ['v8:456', 'chromium:123', 'v8:123'])
 
+  def test_cleanup_list(self):
+    self.assertEqual(git_cl.cleanup_list([]), [])
+    self.assertEqual(git_cl.cleanup_list(None), [])
+    self.assertEqual(
+        git_cl.cleanup_list(['joe@c, john@c', ' joa@c,', 'joe@c']),
+        ['joa@c', 'joe@c', 'john@c'])
+
+  def test_parallel_map(self):
+    self.assertEqual(
+        git_cl._ParallelMap(lambda x: x * 2, range(10), 4),
+        [x * 2 for x in range(10)])
+
+    def fail_on_three(x):
+      if x == 3:
+        raise ValueError('bad item %d' % x)
+      return x
+    with self.assertRaises(ValueError):
+      git_cl._ParallelMap(fail_on_three, range(5), 2)
+
+  def test_split_git_diff(self):
+    renamed = ('diff --git old.h a b.h\n'
+               'similarity index 100%\n'
+               'rename from old.h\n'
+               'rename to a b.h\n')
+    copied = ('diff --git d/a.gn d/b.gn\n'
+              'similarity index 90%\n'
+              'copy from d/a.gn\n'
+              'copy to d/b.gn\n'
+              '--- d/a.gn\n'
+              '+++ d/b.gn\n'
+              '@@ -1 +1 @@\n'
+              '-a\n'
+              '+b\n')
+    changed = ('diff --git dir/a.cc dir/a.cc\n'
+               'index 4e610c0..c57f601 100644\n'
+               '--- dir/a.cc\n'
+               '+++ dir/a.cc\n'
+               '@@ -1,0 +2 @@ int a;\n'
+               '+rename to b.cc\n')
+    self.assertEqual(
+        git_cl.SplitGitDiff(renamed + copied + changed),
+        [('a b.h', renamed), ('d/b.gn', copied), ('dir/a.cc', changed)])
+
   def _test_git_number(self, parent_msg, dest_ref, child_msg,
                        parent_hash='parenthash'):
     desc = git_cl.ChangeDescription(child_msg)
@@ -470,6 +514,7 @@ class TestGitCl(TestCase):
               lambda msg: self._mocked_call(['DieWithError', msg]))
     # It's important to reset settings to not have inter-tests interference.
     git_cl.settings = None
+    git_cl._GitNumbererState.ClearCache()
 
 
   def tearDown(self):
@@ -587,10 +632,10 @@ class TestGitCl(TestCase):
       similarity_call,
       ((['git', 'symbolic-ref', 'HEAD'],), 'master'),
       find_copies_call,
-    ] + cls._is_gerrit_calls() + [
       ((['git', 'symbolic-ref', 'HEAD'],), 'master'),
       ((['git', 'config', 'branch.master.rietveldissue'],), CERR1),
       ((['git', 'config', 'branch.master.gerritissue'],), CERR1),
+    ] + cls._is_gerrit_calls() + [
       ((['git', 'config', 'rietveld.server'],),
        'codereview.example.com'),
       ((['git', 'config', 'branch.master.merge'],), 'master'),
@@ -598,8 +643,7 @@ class TestGitCl(TestCase):
       ((['get_or_create_merge_base', 'master', 'master'],),
        'fake_ancestor_sha'),
     ] + cls._git_sanity_checks('fake_ancestor_sha', 'master') + [
-      ((['git', 'rev-parse', '--show-cdup'],), ''),
-      ((['git', 'rev-parse', 'HEAD'],), '12345'),
+      ((['git', 'rev-parse', '--show-cdup', 'HEAD'],), '\n12345'),
       ((['git', 'diff', '--name-status', '--no-renames', '-r',
          'fake_ancestor_sha...', '.'],),
         'M\t.gitignore\n'),
@@ -876,13 +920,13 @@ class TestGitCl(TestCase):
       ((['git', 'config', 'branch.feature.remote'],), 'origin'),
       ((['git', 'config', 'branch.feature.merge'],), 'refs/heads/master'),
       ((['git', 'config', 'branch.feature.remote'],), 'origin'),
-      ((['git', 'rev-list', '^feature', 'refs/remotes/origin/master'],),
-       ''),  # No commits to rebase, according to local view of origin.
+      ((['git', 'rev-list', '--count', '^feature',
+         'refs/remotes/origin/master'],),
+       '0'),  # No commits to rebase, according to local view of origin.
       ((['git', 'merge-base', 'refs/remotes/origin/master', 'HEAD'],),
        'fake_ancestor_sha'),
     ] + self._git_sanity_checks('fake_ancestor_sha', 'feature') + [
-      ((['git', 'rev-parse', '--show-cdup'],), ''),
-      ((['git', 'rev-parse', 'HEAD'],), 'fake_sha'),
+      ((['git', 'rev-parse', '--show-cdup', 'HEAD'],), '\nfake_sha'),
       ((['git', 'diff', '--name-status', '--no-renames', '-r',
          'fake_ancestor_sha...', '.'],),
        'M\tfile1.cpp'),
@@ -897,12 +941,8 @@ class TestGitCl(TestCase):
        # file1.cpp   |  53 ++++++--
        # 1 file changed, 33 insertions(+), 20 deletions(-)\n
        ''),
-      ((['git', 'show-ref', '--quiet', '--verify',
-         'refs/heads/git-cl-commit'],),
-         ''),   # 0 return code means branch exists.
       ((['git', 'branch', '-D', 'git-cl-commit'],), ''),
-      ((['git', 'show-ref', '--quiet', '--verify',
-         'refs/heads/git-cl-cherry-pick'],),
+      ((['git', 'branch', '-D', 'git-cl-cherry-pick'],),
        CERR1),  # This means git-cl-cherry-pick branch does not exist.
       ((['git', 'rev-parse', '--show-cdup'],), ''),
       ((['git', 'checkout', '-q', '-b', 'git-cl-commit'],), ''),
@@ -910,16 +950,12 @@ class TestGitCl(TestCase):
       ((['git', 'commit', '-m',
          'Issue: 123\n\nR=john@chromium.org\n\n'
          'Review-Url: https://codereview.chromium.org/123 .'],), ''),
-      ((['git', 'config', 'branch.feature.merge'],), 'refs/heads/master'),
-      ((['git', 'config', 'branch.feature.remote'],), 'origin'),
-      ((['git', 'config', '--get', 'remote.origin.url'],),
-       'https://chromium.googlesource.com/infra/infra'),
     ]
 
   def test_land_rietveld(self):
     self._land_rietveld_common(debug=False)
     self.calls += [
-      ((['git', 'config', 'remote.origin.url'],),
+      ((['git', 'config', '--get', 'remote.origin.url'],),
        'https://chromium.googlesource.com/infra/infra'),
       ((['_GitNumbererState',
          'https://chromium.googlesource.com/infra/infra',
@@ -946,7 +982,7 @@ class TestGitCl(TestCase):
     self.mock(git_cl, 'WaitForRealCommit',
               lambda *a: self._mocked_call(['WaitForRealCommit'] + list(a)))
     self.calls += [
-      ((['git', 'config', 'remote.origin.url'],),
+      ((['git', 'config', '--get', 'remote.origin.url'],),
        'https://chromium.googlesource.com/chromium/src'),
       ((['_GitNumbererState',
          'https://chromium.googlesource.com/chromium/src',
@@ -981,6 +1017,31 @@ class TestGitCl(TestCase):
     ]
     git_cl.main(['land'])
 
+  def test_wait_for_real_commit(self):
+    self.mock(git_cl.sys, 'stdout', StringIO.StringIO())
+    git_cl.settings = git_cl.Settings()
+    self.mock(git_cl, 'time_sleep',
+              lambda s: self._mocked_call(['time_sleep', s]))
+    self.calls = [
+      ((['git', 'rev-parse', 'pushed_sha:', 'refs/remotes/origin/master'],),
+       'target_tree\nbase_sha\n'),
+      ((['git', 'config', '--get', 'remote.origin.url'],),
+       'https://chromium.googlesource.com/chromium/src'),
+      ((['git', 'retry', 'fetch', 'origin', 'refs/heads/master'],), ''),
+      ((['git', 'rev-parse', 'FETCH_HEAD'],), 'base_sha\n'),
+      ((['git', 'log', '--format=%H %T', 'base_sha..base_sha'],), ''),
+      ((['time_sleep', 2],), None),
+      ((['git', 'retry', 'fetch', 'origin', 'refs/heads/master'],), ''),
+      ((['git', 'rev-parse', 'FETCH_HEAD'],), 'new_sha\n'),
+      ((['git', 'log', '--format=%H %T', 'base_sha..new_sha'],),
+       'new_sha target_tree\nother_sha other_tree\n'),
+    ]
+    self.assertEqual(
+        'new_sha',
+        git_cl.WaitForRealCommit('origin', 'pushed_sha',
+                                 'refs/remotes/origin/master',
+                                 'refs/heads/master'))
+
   def test_land_rietveld_git_numberer(self):
     self._land_rietveld_common(debug=False)
 
@@ -992,7 +1053,7 @@ class TestGitCl(TestCase):
     self.mock(git_cl, '_git_amend_head', _git_amend_head_mock)
 
     self.calls += [
-      ((['git', 'config', 'remote.origin.url'],),
+      ((['git', 'config', '--get', 'remote.origin.url'],),
        'https://chromium.googlesource.com/chromium/src'),
       ((['_GitNumbererState',
          'https://chromium.googlesource.com/chromium/src',
@@ -1041,7 +1102,7 @@ class TestGitCl(TestCase):
   def test_land_rietveld_git_numberer_bad_parent(self):
     self._land_rietveld_common(debug=False)
     self.calls += [
-      ((['git', 'config', 'remote.origin.url'],),
+      ((['git', 'config', '--get', 'remote.origin.url'],),
        'https://chromium.googlesource.com/v8/v8'),
       ((['_GitNumbererState',
          'https://chromium.googlesource.com/v8/v8', 'refs/heads/master'],),
@@ -1068,6 +1129,10 @@ class TestGitCl(TestCase):
         remote_ref='refs/whatever')
     self.assertEqual(res.pending_prefix, None)
     self.assertEqual(res.should_add_git_number, False)
+    # Loading the same state again is served from the cache.
+    self.assertIs(res, git_cl._GitNumbererState.load(
+        remote_url='https://chromium.googlesource.com/chromium/tools/build',
+        remote_ref='refs/whatever'))
 
   def test_GitNumbererState_fail_fetch(self):
     self.mock(git_cl.sys, 'stdout', StringIO.StringIO())
@@ -1198,11 +1263,11 @@ class TestGitCl(TestCase):
         ((['git', 'symbolic-ref', 'HEAD'],), 'master'),
         ((['git', 'config', '--bool', 'branch.master.git-find-copies'],),
          CERR1),
-      ] + cls._is_gerrit_calls(True) + [
         ((['git', 'symbolic-ref', 'HEAD'],), 'master'),
         ((['git', 'config', 'branch.master.rietveldissue'],), CERR1),
         ((['git', 'config', 'branch.master.gerritissue'],),
           CERR1 if issue is None else str(issue)),
+      ] + ([] if issue else cls._is_gerrit_calls(True)) + [
         ((['git', 'config', 'branch.master.merge'],), 'refs/heads/master'),
         ((['git', 'config', 'branch.master.remote'],), 'origin'),
         ((['get_or_create_merge_base', 'master',
@@ -1212,8 +1277,7 @@ class TestGitCl(TestCase):
       ] + (cls._gerrit_ensure_auth_calls(issue=issue) +
            cls._git_sanity_checks('fake_ancestor_sha', 'master',
                                   get_remote_branch=False)) + [
-        ((['git', 'rev-parse', '--show-cdup'],), ''),
-        ((['git', 'rev-parse', 'HEAD'],), '12345'),
+        ((['git', 'rev-parse', '--show-cdup', 'HEAD'],), '\n12345'),
 
         ((['git',
            'diff', '--name-status', '--no-renames', '-r',
@@ -1299,13 +1363,10 @@ class TestGitCl(TestCase):
            'refs/heads/master'),
           ((['git', 'config', 'branch.master.remote'],),
            'origin'),
-          ((['get_or_create_merge_base', 'master',
-             'refs/remotes/origin/master'],),
-           'origin/master'),
           ((['git', 'rev-parse', 'HEAD:'],),
            '0123456789abcdef'),
           ((['git', 'commit-tree', '0123456789abcdef', '-p',
-             'origin/master', '-m', description],),
+             'fake_ancestor_sha', '-m', description],),
            ref_to_push),
           ]
     else:
@@ -1357,6 +1418,11 @@ class TestGitCl(TestCase):
           ((['git', 'config', 'branch.master.gerritsquashhash',
              'abcdef0123456789'],), ''),
       ]
+    if issue:
+      # Settings are only loaded lazily when the branch already has an issue.
+      calls += [
+          ((['git', 'config', 'rietveld.autoupdate'],), ''),
+      ]
     calls += [
         ((['git', 'config', 'rietveld.cc'],), ''),
         ((['AddReviewers', 'chromium-review.googlesource.com',
@@ -1483,7 +1549,7 @@ class TestGitCl(TestCase):
         [],
         'desc\nBUG=\n\nChange-Id: 123456789',
         [],
-        expected_upstream_ref='origin/master')
+        expected_upstream_ref='fake_ancestor_sha')
 
   def test_gerrit_upload_squash_first(self):
     # Mock Gerrit CL description to indicate the first upload.
@@ -1494,7 +1560,7 @@ class TestGitCl(TestCase):
         'desc\nBUG=\n\nChange-Id: 123456789',
         [],
         squash=True,
-        expected_upstream_ref='origin/master')
+        expected_upstream_ref='fake_ancestor_sha')
 
   def test_gerrit_upload_squash_reupload(self):
     description = 'desc\nBUG=\n\nChange-Id: 123456789'
@@ -1510,7 +1576,7 @@ class TestGitCl(TestCase):
         description,
         [],
         squash=True,
-        expected_upstream_ref='origin/master',
+        expected_upstream_ref='fake_ancestor_sha',
         issue=123456)
 
   def test_upload_branch_deps(self):
@@ -1677,6 +1743,11 @@ class TestGitCl(TestCase):
                        git_cl.GetTargetRef('origin',
                                            'refs/remotes/branch-heads/123',
                                            branch, False))
+    # Only the leading prefix is rewritten.
+    self.assertEqual('refs/heads/foo/heads/bar',
+                     git_cl.GetTargetRef('origin',
+                                         'refs/remotes/origin/master',
+                                         'heads/foo/heads/bar', False))
 
     # Check target refs for pending prefix.
     self.mock(git_cl._GitNumbererState, 'load',
@@ -1866,15 +1937,77 @@ class TestGitCl(TestCase):
     with self.assertRaises(SystemExitMock):
       self.assertEqual(1, git_cl.main(['patch', url + '/#/c/123456/1']))
 
+  def _format_diff_chunk(self, path):
+    return ('diff --git %s %s\n'
+            'index 4e610c0..c57f601 100644\n'
+            '--- %s\n'
+            '+++ %s\n'
+            '@@ -1,0 +2 @@\n'
+            '+changed\n' % (path, path, path, path))
+
+  def _format_common(self):
+    self.mock(git_cl, 'RunCommand',
+              lambda args, **kw: self._mocked_call(args, kw.get('stdin')))
+    self.mock(git_cl.clang_format, 'FindClangFormatToolInChromiumTree',
+              lambda: '/bin/clang-format')
+    self.mock(git_cl.clang_format, 'FindClangFormatScriptInChromiumTree',
+              lambda name: '/scripts/' + name)
+    self.mock(git_cl.gclient_utils, 'FindExecutable', lambda name: '/bin/yapf')
+    self.mock(git_cl.os, 'getcwd', lambda: '/root')
+    self.mock(git_cl.multiprocessing, 'cpu_count', lambda: 1)
+
+  def _format_calls(self, diff_type, diff_output):
+    return [
+      ((['git', 'rev-parse', '--show-cdup'], None), ''),
+      ((['git', 'symbolic-ref', 'HEAD'], None), 'master'),
+      ((['git', 'config', 'branch.master.rietveldissue'],), CERR1),
+      ((['git', 'config', 'branch.master.gerritissue'],), CERR1),
+      ((['git', 'config', 'rietveld.autoupdate'], None), ''),
+      ((['git', 'config', 'gerrit.host'], None), ''),
+      ((['git', 'config', 'rietveld.server'], None),
+       'codereview.example.com'),
+      ((['git', 'config', 'branch.master.merge'],), 'refs/heads/master'),
+      ((['git', 'config', 'branch.master.remote'],), 'origin'),
+      ((['git', 'merge-base', 'HEAD', 'refs/remotes/origin/master'], None),
+       'base_sha\n'),
+      ((['git', 'diff', '--no-ext-diff', '--no-prefix', '--no-color',
+         '--diff-filter=d', diff_type, 'base_sha', '--'], None),
+       diff_output),
+    ]
+
+  def test_format(self):
+    """Tests git cl format buckets files by the -U0 diff's headers."""
+    self._format_common()
+    cc_chunk = self._format_diff_chunk('a.cc')
+    gn_chunk = self._format_diff_chunk('BUILD.gn')
+    py_chunk = self._format_diff_chunk('b.py')
+    h_chunk = self._format_diff_chunk('dir/c.H')
+    self.calls = self._format_calls(
+        '-U0', cc_chunk + gn_chunk + py_chunk + h_chunk) + [
+      (([sys.executable, '/scripts/clang-format-diff.py', '-p0', '-binary',
+         '/bin/clang-format', '-i'], cc_chunk + h_chunk), ''),
+      ((['gn', 'format', 'BUILD.gn'],), 0),
+    ]
+    self.assertEqual(0, git_cl.main(['format']))
+
+  def test_format_full(self):
+    """Tests git cl format --full buckets files by the --name-only diff."""
+    self._format_common()
+    self.calls = self._format_calls(
+        '--name-only', 'a.cc\nBUILD.gn\nb.py\ndir/c.H\nREADME\n') + [
+      ((['/bin/clang-format', '-i', 'a.cc', 'dir/c.H'],), ''),
+      ((['/bin/yapf', '-i', 'b.py'], None), ''),
+      ((['gn', 'format', 'BUILD.gn'],), 0),
+    ]
+    self.assertEqual(0, git_cl.main(['format', '--full', '--python']))
+
   def _checkout_calls(self):
     return [
         ((['git', 'config', '--local', '--get-regexp',
-           'branch\\..*\\.rietveldissue'], ),
+           '^branch\\..*\\.(gerritissue|rietveldissue)$'], ),
            ('branch.retrying.rietveldissue 1111111111\n'
-            'branch.some-fix.rietveldissue 2222222222\n')),
-        ((['git', 'config', '--local', '--get-regexp',
-           'branch\\..*\\.gerritissue'], ),
-           ('branch.ger-branch.gerritissue 123456\n'
+            'branch.some-fix.rietveldissue 2222222222\n'
+            'branch.ger-branch.gerritissue 123456\n'
             'branch.gbranch654.gerritissue 654321\n')),
     ]
 
@@ -1901,9 +2034,7 @@ class TestGitCl(TestCase):
     self.mock(git_cl.sys, 'stdout', StringIO.StringIO())
     self.calls = [
         ((['git', 'config', '--local', '--get-regexp',
-           'branch\\..*\\.rietveldissue'], ), CERR1),
-        ((['git', 'config', '--local', '--get-regexp',
-           'branch\\..*\\.gerritissue'], ), CERR1),
+           '^branch\\..*\\.(gerritissue|rietveldissue)$'], ), CERR1),
     ]
     self.assertEqual(1, git_cl.main(['checkout', '99999']))
 
@@ -2272,6 +2403,27 @@ class TestGitCl(TestCase):
     ]
     self.assertEqual(0, git_cl.main(['issue', '--json', 'output.json']))
 
+  def test_cmd_issue_reverse(self):
+    out = StringIO.StringIO()
+    self.mock(git_cl.sys, 'stdout', out)
+    self.calls = [
+        ((['git', 'for-each-ref', 'refs/heads', '--format=%(refname:short)'],),
+         'feature\nmaster\nother.branch\n'),
+        ((['git', 'config', '--local', '--get-regexp',
+           r'^branch\..*\.(gerritissue|rietveldissue)$'],),
+         'branch.feature.rietveldissue 123\n'
+         'branch.other.branch.gerritissue 456\n'
+         'branch.deleted.rietveldissue 123\n'),
+        (('write_json', 'output.json',
+          {123: ['feature'], 456: ['other.branch']}), ''),
+    ]
+    self.assertEqual(0, git_cl.main(['issue', '--reverse',
+                                     '--json', 'output.json']))
+    self.assertEqual(
+        'Branch for issue number 123: feature\n'
+        'Branch for issue number 456: other.branch\n',
+        out.getvalue())
+
   def test_git_cl_try_default_cq_dry_run(self):
     self.mock(git_cl.Changelist, 'GetChange',
               lambda _, *a: (
@@ -2635,6 +2787,53 @@ class TestGitCl(TestCase):
     ]
     cl._codereview_impl._GerritCommitMsgHookCheck(offer_removal=True)
 
+  def test_urlretrieve_returns_head(self):
+    content = '#!/bin/sh\n' + 'x' * (128 * 1024)
+    self.mock(git_cl.urllib2, 'urlopen',
+              lambda url: StringIO.StringIO(content))
+    fd, path = tempfile.mkstemp(prefix='git_cl_test')
+    os.close(fd)
+    try:
+      self.assertEqual('#!', git_cl.urlretrieve('https://example.com', path))
+      with open(path) as f:
+        self.assertEqual(content, f.read())
+    finally:
+      os.remove(path)
+
+  def test_tree_status(self):
+    responses = {
+      'https://status.example.com/': 'Tree is CLOSED for maintenance',
+      'https://status.example.com/current?format=json':
+          json.dumps({'message': 'Tree is closed for maintenance'}),
+    }
+    self.mock(git_cl._TREE_STATUS_HTTP, 'request',
+              lambda url: (git_cl.httplib2.Response({'status': '200'}),
+                           responses[url]))
+    git_cl.settings = git_cl.Settings()
+    self.mock(git_cl.settings, 'GetTreeStatusUrl',
+              lambda error_ok=False: 'https://status.example.com/')
+    self.assertEqual('closed', git_cl.GetTreeStatus())
+    self.assertEqual('Tree is closed for maintenance',
+                     git_cl.GetTreeStatusReason())
+
+  def test_buildbucket_retry_on_timeout(self):
+    self.mock(git_cl, 'time_sleep',
+              lambda s: self._mocked_call(['time_sleep', s]))
+    responses = [
+      git_cl.socket.timeout('timed out'),
+      (git_cl.httplib2.Response({'status': '200'}), '{"builds": []}'),
+    ]
+    class FakeHttp(object):
+      def request(self, *_args, **_kwargs):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+          raise response
+        return response
+    self.calls = [((['time_sleep', 0.5],), None)]
+    self.assertEqual(
+        {'builds': []},
+        git_cl._buildbucket_retry('fetching try jobs', FakeHttp(), 'url'))
+
   def test_GerritCmdLand(self):
     self.calls += [
       ((['git', 'symbolic-ref', 'HEAD'],), 'feature'),